@@ -1,8 +1,12 @@
 # Добавим текстуру неба
 
-from vispy import gloo, app, io
+import os
+import tempfile
+import threading
+import time
 
-from surface import *
+import numpy as np
+from vispy import gloo, app, io
 
 SUN_CONTROL_STEP = 0.01
 
@@ -11,7 +15,7 @@ VS = ("""
 uniform float u_eye_height;
 uniform mat4 u_world_view;
 uniform float u_alpha;
-uniform float u_bed_depth;
+attribute float a_bed_depth;
 attribute vec2 a_position;
 attribute float a_height;
 attribute vec2 a_normal;
@@ -40,15 +44,17 @@ void main (void) {
     float c2=sqrt(d);
     vec3 refracted=normalize(u_alpha*cross(cr,normal)-normal*c2);
     float c1=-dot(normal,from_eye);
-    float t=(-u_bed_depth-v_position.z)/refracted.z;
-    vec3 point_on_bed=v_position+t*refracted;
-    v_bed_texcoord=point_on_bed.xy+vec2(0.5,0.5);
     float reflectance_s=pow((u_alpha*c1-c2)/(u_alpha*c1+c2),2);
     float reflectance_p=pow((u_alpha*c2-c1)/(u_alpha*c2+c1),2);
     v_reflectance=(reflectance_s+reflectance_p)*2;
+#if defined(BED) || defined(DEPTH)
+    float t=(-a_bed_depth-v_position.z)/refracted.z;
+    vec3 point_on_bed=v_position+t*refracted;
+    v_bed_texcoord=point_on_bed.xy+vec2(0.5,0.5);
     float diw=length(point_on_bed-v_position);
     vec3 doFilter=vec3(1,0.5,0.2);
     v_mask=vec3(exp(-diw*doFilter.x),exp(-diw*doFilter.y),exp(-diw*doFilter.z));
+#endif
     v_reflected_from_bed = vec3(from_eye.x, from_eye.y, -from_eye.z);
 }
 """)
@@ -60,11 +66,6 @@ uniform sampler2D u_bed_texture;
 uniform vec3 u_sun_direction;
 uniform vec3 u_sun_diffused_color;
 uniform vec3 u_sun_reflected_color;
-uniform float u_reflected_mult;
-uniform float u_diffused_mult;
-uniform float u_bed_mult;
-uniform float u_depth_mult;
-uniform float u_sky_mult;
 varying vec3 v_normal;
 varying vec3 v_position;
 varying vec3 v_reflected;
@@ -74,22 +75,30 @@ varying float v_reflectance;
 varying vec3 v_reflected_from_bed;
 varying vec3 v_mask;
 void main() {
-    vec3 sky_color=texture2D(u_sky_texture, v_sky_texcoord).rgb;
-    vec3 bed_color=texture2D(u_bed_texture, v_bed_texcoord).rgb;
     vec3 normal=normalize(v_normal);
-    float diffused_intensity=u_diffused_mult*max(0, -dot(normal, u_sun_direction));
-    float cosphi=max(0,dot(u_sun_direction,normalize(v_reflected)));
-    float reflected_intensity=u_reflected_mult*pow(cosphi,100);
+    vec3 sky_color=vec3(0,0,0);
+#ifdef SKY
+    sky_color=texture2D(u_sky_texture, v_sky_texcoord).rgb;
+#endif
+    vec3 image_color=vec3(0,0,0);
+#ifdef BED
+    vec3 bed_color=texture2D(u_bed_texture, v_bed_texcoord).rgb;
+    image_color+=bed_color*v_mask;
+#endif
+#ifdef DEPTH
     vec3 ambient_water=vec3(0,0.4,0.42);
-    vec3 image_color=(u_bed_mult*bed_color*v_mask+u_depth_mult*ambient_water*(1-v_mask))*(vec3(0.5, 0.5, 0.5));
+    image_color+=ambient_water*(1-v_mask);
+#endif
+    image_color*=vec3(0.5, 0.5, 0.5);
+    vec3 diffused=vec3(0,0,0);
+#ifdef DIFFUSED
+    diffused=0.5*max(0, -dot(normal, u_sun_direction))*u_sun_diffused_color;
+#endif
     float v_ref = v_reflectance;
-    float through_intensity = 0;
     float reflected_image = 0;
     if (v_ref > 1){
         //assuming we r under water now
         v_ref = 1;
-        vec3 tmp = vec3(v_reflected.x, v_reflected.y, -v_reflected.z);
-        through_intensity = u_reflected_mult*pow(max(0,dot(u_sun_direction,normalize(tmp))),100);
     }
     if (v_reflected.z < 0){
         float cosa = max(0, dot(normal, normalize(v_reflected)));
@@ -99,23 +108,14 @@ void main() {
         reflected_image = pow(-(cosa - 1),2);
         v_ref = real_cos;
     }
-    vec3 ro = u_sky_mult*sky_color*v_ref+image_color*(1-v_ref)
-        +diffused_intensity*u_sun_diffused_color+reflected_intensity*u_sun_reflected_color
-        + reflected_image*image_color;
-        
-    cosphi=max(0,dot(u_sun_direction,normalize(v_reflected_from_bed)));
-    reflected_intensity=u_reflected_mult*pow(cosphi,100);
-    ambient_water=vec3(0,0.4,0.42);
-    image_color=(u_bed_mult*bed_color*v_mask+u_depth_mult*ambient_water*(1-v_mask))*(vec3(0.5, 0.5, 0.5));
-    v_ref = v_reflectance;
-    through_intensity = 0;
+    vec3 ro = sky_color*v_ref+image_color*(1-v_ref)+diffused+reflected_image*image_color;
+#ifdef REFLECTED
+    ro += pow(max(0,dot(u_sun_direction,normalize(v_reflected))),100)*u_sun_reflected_color;
+#endif
+
+    //assuming we r under water now
+    v_ref = 1;
     reflected_image = 0;
-    if (true){
-        //assuming we r under water now
-        v_ref = 1;
-        vec3 tmp = vec3(v_reflected_from_bed.x, v_reflected_from_bed.y, -v_reflected_from_bed.z);
-        through_intensity = u_reflected_mult*pow(max(0,dot(u_sun_direction,normalize(tmp))),100);
-    }
     if (v_reflected_from_bed.z < 0){
         float cosa = max(0, dot(normal, normalize(v_reflected_from_bed)));
         float sina = sqrt(1 - cosa*cosa);
@@ -124,11 +124,10 @@ void main() {
         reflected_image = pow(-(cosa - 1),2);
         v_ref = real_cos;
     }
-    vec3 rn = u_sky_mult*sky_color*v_ref+image_color*(1-v_ref)
-        +diffused_intensity*u_sun_diffused_color+reflected_intensity*u_sun_reflected_color
-        + reflected_image*image_color;
-
-    
+    vec3 rn = sky_color*v_ref+image_color*(1-v_ref)+diffused+reflected_image*image_color;
+#ifdef REFLECTED
+    rn += pow(max(0,dot(u_sun_direction,normalize(v_reflected_from_bed))),100)*u_sun_reflected_color;
+#endif
 
     vec3 rgb= rn + ro;
     gl_FragColor.rgb = clamp(rgb,0.0,1.0);
@@ -144,59 +143,153 @@ void main() {w
 """
 
 
+def shader_variant(source, defines):
+    # defines go right after the #version line, which has to stay first
+    header = "".join("#define {}\n".format(name) for name in defines)
+    return source.replace("#version 120\n", "#version 120\n" + header, 1)
+
+
 def normalize(vec):
     vec = np.asarray(vec, dtype=np.float32)
     return vec / np.sqrt(np.sum(vec * vec, axis=-1))[..., None]
 
 
+def load_texture(path):
+    # decoded png is cached next to it as .npy, which loads much faster than decoding again;
+    # the cache is written to a temporary file first so an interrupted write never leaves
+    # a truncated .npy behind, and an unreadable cache falls back to decoding the png
+    cache = path + ".npy"
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        try:
+            return np.load(cache)
+        except (IOError, OSError, ValueError, EOFError):
+            pass
+    image = io.read_png(path)
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(os.path.abspath(cache)))
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, image)
+        os.replace(tmp, cache)
+    except (IOError, OSError):
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+    return image
+
+
 class Canvas(app.Canvas):
-    def __init__(self, surface, sky="fluffy_clouds.png", bed="seabed.png"):
+    def __init__(self, surface, sky="fluffy_clouds.png", bed="seabed.png", bed_depth=2):
+        self.startup_phases = []
+        self._phase_start = time.time()
         # store parameters
         self.surface = surface
-        # read textures
-        self.sky = io.read_png(sky)
-        self.bed = io.read_png(bed)
+        # read textures in the background, gray placeholders are shown until they arrive
+        self.sky = self.bed = None
+        self._textures_ready = False
+        self._texture_error = None
+        self._texture_loader = threading.Thread(target=self.load_textures, args=(sky, bed))
+        self._texture_loader.daemon = True
+        self._texture_loader.start()
         # create GL context
         app.Canvas.__init__(self, size=(600, 600), title="Water surface simulator 2")
+        self.startup_phase("window")
         # Compile shaders and set constants
-        self.program = gloo.Program(VS, FS_triangle)
+        self.programs = {}
+        self.program_data = {}
+        self._new_variant = None
+        self.diffused_flag = False
+        self.reflected_flag = True
+        self.bed_flag = True
+        self.depth_flag = True
+        self.sky_flag = True
+        self.apply_flags()
         self.program_point = gloo.Program(VS, FS_point)
         pos = self.surface.position()
-        self.program["a_position"] = pos
-        self.program_point["a_position"] = pos
-        self.program['u_sky_texture'] = gloo.Texture2D(self.sky, wrapping='repeat', interpolation='linear')
-        self.program['u_bed_texture'] = gloo.Texture2D(self.bed, wrapping='repeat', interpolation='linear')
-        self.program_point["u_eye_height"] = self.program["u_eye_height"] = 3
-        self.program["u_alpha"] = 0.9
-        self.program["u_bed_depth"] = 2
+        # static vertex data lives in buffers shared by every shader variant
+        positions = gloo.VertexBuffer(pos.reshape(-1, 2))
+        self.set_program("a_position", positions)
+        self.program_point["a_position"] = positions
+        # per-frame data is refilled with set_data, so visited variants don't keep their own copies
+        self.heights = gloo.VertexBuffer(np.zeros((pos.shape[0] * pos.shape[1], 1), dtype=np.float32))
+        self.normals = gloo.VertexBuffer(np.zeros((pos.shape[0] * pos.shape[1], 2), dtype=np.float32))
+        self.set_program("a_height", self.heights)
+        self.set_program("a_normal", self.normals)
+        self.program_point["a_height"] = self.heights
+        placeholder = np.full((1, 1, 3), 128, dtype=np.uint8)
+        self.sky_texture = gloo.Texture2D(placeholder, wrapping='repeat', interpolation='linear')
+        self.bed_texture = gloo.Texture2D(placeholder, wrapping='repeat', interpolation='linear')
+        self.set_program('u_sky_texture', self.sky_texture)
+        self.set_program('u_bed_texture', self.bed_texture)
+        self.set_program("u_eye_height", 3)
+        self.program_point["u_eye_height"] = 3
+        self.set_program("u_alpha", 0.9)
+        depth = self.surface.depth()
+        if depth is None:
+            depth = np.full(pos.shape[:2], bed_depth, dtype=np.float32)
+        self.set_program("a_bed_depth", gloo.VertexBuffer(np.asarray(depth, dtype=np.float32).reshape(-1, 1)))
         self.sun_direction = [0, 0, 0.1]
-        self.program["u_sun_direction"] = normalize(self.sun_direction)
-        self.program["u_sun_diffused_color"] = [1, 0.8, 1]
-        self.program["u_sun_reflected_color"] = [1, 0.8, 0.6]
+        self.set_program("u_sun_direction", normalize(self.sun_direction))
+        self.set_program("u_sun_diffused_color", [1, 0.8, 1])
+        self.set_program("u_sun_reflected_color", [1, 0.8, 0.6])
         self.triangles = gloo.IndexBuffer(self.surface.triangulation())
+        self.startup_phase("geometry")
         # Set up GUI
         self.camera = np.array([0, 0, 1])
         self.up = np.array([0, 1, 0])
         self.set_camera()
         self.are_points_visible = False
         self.drag_start = None
-        self.diffused_flag = False;
-        self.reflected_flag = True;
-        self.bed_flag = True;
-        self.depth_flag = True;
-        self.sky_flag = True;
-        self.apply_flags();
         # Run everything
         self._timer = app.Timer('auto', connect=self.on_timer, start=True)
         self.activate_zoom()
         self.show()
 
+    def startup_phase(self, name):
+        now = time.time()
+        self.startup_phases.append((name, now - self._phase_start))
+        self._phase_start = now
+
+    def report_startup(self):
+        total = sum(seconds for name, seconds in self.startup_phases)
+        print("Startup: " + ", ".join("{} {:.3f}s".format(name, seconds) for name, seconds in self.startup_phases)
+              + ", total {:.3f}s".format(total))
+
+    def load_textures(self, sky, bed):
+        # runs on a worker thread: only decode here, GL uploads happen in on_draw,
+        # and errors are handed over to be reported there as well
+        start = time.time()
+        try:
+            self.sky = load_texture(sky)
+            self.bed = load_texture(bed)
+        except Exception as e:
+            self._texture_error = e
+            return
+        self.texture_load_time = time.time() - start
+        self._textures_ready = True
+
+    def upload_textures(self):
+        self.sky_texture.set_data(self.sky)
+        self.bed_texture.set_data(self.bed)
+        self._textures_ready = False
+        print("Textures loaded in background: {:.3f}s".format(self.texture_load_time))
+
     def apply_flags(self):
-        self.program["u_diffused_mult"] = 0.5 if self.diffused_flag else 0;
-        self.program["u_reflected_mult"] = 1.0 if self.reflected_flag else 0;
-        self.program["u_bed_mult"] = 1 if self.bed_flag else 0;
-        self.program["u_depth_mult"] = 1 if self.depth_flag else 0;
-        self.program["u_sky_mult"] = 1 if self.sky_flag else 0;
+        # every combination of flags is its own compiled program, so disabled effects cost nothing
+        key = (self.diffused_flag, self.reflected_flag, self.bed_flag, self.depth_flag, self.sky_flag)
+        if key not in self.programs:
+            names = ("DIFFUSED", "REFLECTED", "BED", "DEPTH", "SKY")
+            defines = [name for name, flag in zip(names, key) if flag]
+            program = gloo.Program(shader_variant(VS, defines), shader_variant(FS_triangle, defines))
+            self.programs[key] = program
+            self._new_variant = defines
+        self.program = self.programs[key]
+        for name, value in self.program_data.items():
+            self.program[name] = value
+
+    def set_program(self, name, value):
+        # remembered so that a variant compiled later gets the same state
+        self.program_data[name] = value
+        self.program[name] = value
 
     def set_camera(self):
         rotation = np.zeros((4, 4), dtype=np.float32)
@@ -205,7 +298,7 @@ class Canvas(app.Canvas):
         rotation[1, :3] = self.up
         rotation[2, :3] = self.camera
         world_view = rotation
-        self.program['u_world_view'] = world_view.T
+        self.set_program('u_world_view', world_view.T)
         self.program_point['u_world_view'] = world_view.T
 
     def rotate_camera(self, shift):
@@ -221,17 +314,33 @@ class Canvas(app.Canvas):
         gloo.set_viewport(0, 0, *self.physical_size)
 
     def on_draw(self, event):
+        if self._texture_error is not None:
+            # reported once, drawing goes on with the gray placeholders
+            error, self._texture_error = self._texture_error, None
+            print("Could not load textures: {!r}".format(error))
+        if self._textures_ready:
+            self.upload_textures()
         gloo.set_state(clear_color=(0, 0, 0, 1), blend=False)
         gloo.clear()
         h, grad = self.surface.height_and_normal()
-        self.program["a_height"] = h
-        self.program["a_normal"] = grad
+        self.heights.set_data(np.asarray(h, dtype=np.float32).reshape(-1, 1))
+        self.normals.set_data(np.asarray(grad, dtype=np.float32).reshape(-1, 2))
         gloo.set_state(depth_test=True)
+        start = time.time()
         self.program.draw('triangles', self.triangles)
+        if self._new_variant is not None and self._phase_start is None:
+            # a new variant is compiled when it is first drawn
+            print("Compiled shader variant {}: {:.3f}s".format(" ".join(self._new_variant) or "(none)",
+                                                               time.time() - start))
+        self._new_variant = None
         if self.are_points_visible:
-            self.program_point["a_height"] = h
             gloo.set_state(depth_test=False)
             self.program_point.draw('points')
+        if self._phase_start is not None:
+            # gloo only queues GL commands, shaders are compiled during the first draw
+            self.startup_phase("first frame (shader compile, GL upload)")
+            self._phase_start = None
+            self.report_startup()
 
     def on_timer(self, event):
         self.surface.propagate(0.01)
@@ -247,37 +356,37 @@ class Canvas(app.Canvas):
             self.are_points_visible = not self.are_points_visible
             print("Show lattice vertices:", self.are_points_visible)
         elif event.key == '1':
-            self.diffused_flag = not self.diffused_flag;
+            self.diffused_flag = not self.diffused_flag
             print("Show sun diffused light:", self.diffused_flag)
-            self.apply_flags();
+            self.apply_flags()
         elif event.key == '2':
-            self.bed_flag = not self.bed_flag;
+            self.bed_flag = not self.bed_flag
             print("Show refracted image of seabed:", self.bed_flag)
-            self.apply_flags();
+            self.apply_flags()
         elif event.key == '3':
-            self.depth_flag = not self.depth_flag;
+            self.depth_flag = not self.depth_flag
             print("Show ambient light in water:", self.depth_flag)
-            self.apply_flags();
+            self.apply_flags()
         elif event.key == '4':
-            self.sky_flag = not self.sky_flag;
+            self.sky_flag = not self.sky_flag
             print("Show reflected image of sky:", self.sky_flag)
-            self.apply_flags();
+            self.apply_flags()
         elif event.key == '5':
-            self.reflected_flag = not self.reflected_flag;
+            self.reflected_flag = not self.reflected_flag
             print("Show reflected image of sun:", self.reflected_flag)
-            self.apply_flags();
+            self.apply_flags()
         elif event.key == 'w':
             self.sun_direction[1] += SUN_CONTROL_STEP
-            self.program["u_sun_direction"] = normalize(self.sun_direction);
+            self.set_program("u_sun_direction", normalize(self.sun_direction))
         elif event.key == 'd':
             self.sun_direction[0] += SUN_CONTROL_STEP
-            self.program["u_sun_direction"] = normalize(self.sun_direction);
+            self.set_program("u_sun_direction", normalize(self.sun_direction))
         elif event.key == 's':
             self.sun_direction[1] -= SUN_CONTROL_STEP
-            self.program["u_sun_direction"] = normalize(self.sun_direction);
+            self.set_program("u_sun_direction", normalize(self.sun_direction))
         elif event.key == 'a':
             self.sun_direction[0] -= SUN_CONTROL_STEP
-            self.program["u_sun_direction"] = normalize(self.sun_direction);
+            self.set_program("u_sun_direction", normalize(self.sun_direction))
 
     def screen_to_gl_coordinates(self, pos):
         return 2 * np.array(pos) / np.array(self.size) - 1
@@ -298,8 +407,12 @@ class Canvas(app.Canvas):
 
 
 if __name__ == '__main__':
+    from surface import ParallelWave
+    # from surface import Surface, CircularWaves, depth_from_image
     # surface = Surface(size=(100, 100), nwave=5, max_height=0.05)
     # surface = CircularWaves(size=(100, 100), max_height=0.01)
+    # surface = ParallelWave(depth=depth_from_image(load_texture("seabed.png"), (100, 100)))
+    # surface = ParallelWave(initial="gaussian", initial_args={"width": 0.05}, max_height=0.05)
     surface = ParallelWave()
     c = Canvas(surface)
     c.measure_fps()
@@ -11,7 +11,7 @@ VS = ("""
 uniform float u_eye_height;
 uniform mat4 u_world_view;
 uniform float u_alpha;
-uniform float u_bed_depth;
+attribute float a_bed_depth;
 attribute vec2 a_position;
 attribute float a_height;
 attribute vec2 a_normal;
@@ -40,7 +40,7 @@ void main (void) {
     float c2=sqrt(d);
     vec3 refracted=normalize(u_alpha*cross(cr,normal)-normal*c2);
     float c1=-dot(normal,from_eye);
-    float t=(-u_bed_depth-v_position.z)/refracted.z;
+    float t=(-a_bed_depth-v_position.z)/refracted.z;
     vec3 point_on_bed=v_position+t*refracted;
     v_bed_texcoord=point_on_bed.xy+vec2(0.5,0.5);
     float reflectance_s=pow((u_alpha*c1-c2)/(u_alpha*c1+c2),2);
@@ -150,7 +150,7 @@ def normalize(vec):
 
 
 class Canvas(app.Canvas):
-    def __init__(self, surface, sky="fluffy_clouds.png", bed="seabed.png"):
+    def __init__(self, surface, sky="fluffy_clouds.png", bed="seabed.png", bed_depth=2):
         # store parameters
         self.surface = surface
         # read textures
@@ -168,7 +168,10 @@ class Canvas(app.Canvas):
         self.program['u_bed_texture'] = gloo.Texture2D(self.bed, wrapping='repeat', interpolation='linear')
         self.program_point["u_eye_height"] = self.program["u_eye_height"] = 3
         self.program["u_alpha"] = 0.9
-        self.program["u_bed_depth"] = 2
+        depth = self.surface.depth()
+        if depth is None:
+            depth = np.full(pos.shape[:2], bed_depth, dtype=np.float32)
+        self.program["a_bed_depth"] = np.asarray(depth, dtype=np.float32)
         self.sun_direction = [0, 0, 0.1]
         self.program["u_sun_direction"] = normalize(self.sun_direction)
         self.program["u_sun_diffused_color"] = [1, 0.8, 1]
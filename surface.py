@@ -1,16 +1,123 @@
+from collections import OrderedDict
+
 import numpy as np
 
 
+def depth_from_image(image, size, min_depth=0.5, max_depth=2.0):
+    # bright sand is shallow, dark areas are deep; sampled with the same
+    # texture coordinates the shader uses for the seabed (xy + 0.5, repeated)
+    image = np.asarray(image, dtype=np.float32)
+    if image.ndim == 3:
+        image = image[:, :, :3].mean(axis=-1)
+    lum = (image - image.min()) / max(image.max() - image.min(), 1e-6)
+    cols = (np.mod(np.linspace(-1, 1, size[0]) + 0.5, 1) * (image.shape[1] - 1)).astype(int)
+    rows = (np.mod(np.linspace(-1, 1, size[1]) + 0.5, 1) * (image.shape[0] - 1)).astype(int)
+    return (max_depth - (max_depth - min_depth) * lum[rows[None, :], cols[:, None]]).astype(np.float32)
+
+
+def _periodic_grid(size):
+    x = np.linspace(-1, 1, size[0] + 1, dtype=np.float32)[:-1, None]
+    y = np.linspace(-1, 1, size[1] + 1, dtype=np.float32)[None, :-1]
+    return x, y
+
+
+def sine_mode(size, max_height, kx=1, ky=0):
+    # sin/cos are taken along each axis and combined, so only the final grids are full size
+    x, y = _periodic_grid(size)
+    sx, cx = max_height * np.sin(np.pi * kx * x), max_height * np.cos(np.pi * kx * x)
+    if ky == 0:
+        return np.broadcast_to(sx, size).astype(np.float32), np.broadcast_to(cx, size).astype(np.float32)
+    sy, cy = np.sin(np.pi * ky * y), np.cos(np.pi * ky * y)
+    h = (sx * cy + cx * sy).astype(np.float32, copy=False)
+    v = (cx * cy - sx * sy).astype(np.float32, copy=False)
+    return h, v
+
+
+def gaussian_pulse(size, max_height, center=(0., 0.), width=0.1):
+    x, y = _periodic_grid(size)
+    r2 = (x - center[0]) ** 2 + (y - center[1]) ** 2
+    h = max_height * np.exp(-r2 / (2 * width ** 2))
+    return h.astype(np.float32), np.zeros(size, dtype=np.float32)
+
+
+def random_spectrum(size, max_height, k_max=8, seed=None):
+    # random phases with a gaussian falloff in wave number, scaled to max_height;
+    # only modes with |k| <= 3 * k_max matter, so they are summed directly as
+    # Re(Ex C Ey^T) in float32 instead of transforming the whole grid
+    rng = np.random.RandomState(seed)
+    kx = np.arange(-min(int(3 * k_max), size[0] // 2), min(int(3 * k_max), size[0] // 2) + 1)
+    ky = np.arange(-min(int(3 * k_max), size[1] // 2), min(int(3 * k_max), size[1] // 2) + 1)
+    envelope = np.exp(-(kx[:, None] ** 2 + ky[None, :] ** 2) / float(k_max) ** 2)
+    cr = (rng.randn(kx.size, ky.size) * envelope).astype(np.float32)
+    ci = (rng.randn(kx.size, ky.size) * envelope).astype(np.float32)
+    x, y = _periodic_grid(size)
+    ax = np.pi * x * kx[None, :].astype(np.float32)
+    ay = np.pi * y.T * ky[None, :].astype(np.float32)
+    cos_y, sin_y = np.cos(ay).T, np.sin(ay).T
+    h = np.cos(ax).dot(cr.dot(cos_y) - ci.dot(sin_y))
+    h -= np.sin(ax).dot(cr.dot(sin_y) + ci.dot(cos_y))
+    h *= max_height / max(h.max(), -h.min(), 1e-30)
+    return h.astype(np.float32, copy=False), np.zeros(size, dtype=np.float32)
+
+
+def from_file(size, max_height, path):
+    # .npy holds either h or a stacked (h, v) pair of heights used as they are, max_height is
+    # not applied; images are read as gray levels scaled to +-max_height, with image columns
+    # along x and rows along y like depth_from_image and the seabed texture
+    if path.endswith(".npy"):
+        data = np.load(path).astype(np.float32)
+    else:
+        from vispy import io
+        data = np.asarray(io.read_png(path), dtype=np.float32)[:, :, :3].mean(axis=-1)
+        data = max_height * (2 * (data - data.min()) / max(data.max() - data.min(), 1e-6) - 1)
+        data = np.ascontiguousarray(data.T)
+    if data.ndim == 3:
+        h, v = data[0], data[1]
+    else:
+        h, v = data, np.zeros_like(data)
+    if h.shape != tuple(size):
+        raise ValueError("initial condition has shape {}, expected {}".format(h.shape, tuple(size)))
+    return h, v
+
+
+INITIAL_CONDITIONS = {
+    "sine": sine_mode,
+    "gaussian": gaussian_pulse,
+    "random": random_spectrum,
+    "file": from_file,
+}
+
+
+def _bilinear(field, x, y):
+    # field is sampled on the linspace(-1, 1, n) grid of position(); points outside are clamped
+    n0, n1 = field.shape[:2]
+    fx = np.clip((np.asarray(x) + 1) / 2 * (n0 - 1), 0, n0 - 1)
+    fy = np.clip((np.asarray(y) + 1) / 2 * (n1 - 1), 0, n1 - 1)
+    i = np.minimum(fx.astype(int), n0 - 2)
+    j = np.minimum(fy.astype(int), n1 - 2)
+    wx = (fx - i).reshape(i.shape + (1,) * (field.ndim - 2))
+    wy = (fy - j).reshape(j.shape + (1,) * (field.ndim - 2))
+    return ((1 - wx) * (1 - wy) * field[i, j] + wx * (1 - wy) * field[i + 1, j]
+            + (1 - wx) * wy * field[i, j + 1] + wx * wy * field[i + 1, j + 1]).astype(np.float32)
+
+
 # noinspection PyUnresolvedReferences
 class PlaneWaves(object):
-    def __init__(self, size=(100, 100), nwave=5, max_height=0.2):
+    def __init__(self, size=(100, 100), nwave=5, max_height=0.2, cache_size=8,
+                 cache_bytes=64 * 2 ** 20):
         self._size = size
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_bytes = cache_bytes
         self._wave_vector = 5 * (2 * np.random.rand(nwave, 2) - 1)
         self._angular_frequency = 2 * np.random.rand(nwave)
         self._phase = 2 * np.pi * np.random.rand(nwave)
         self._amplitude = max_height * (1 + np.random.rand(nwave)) / 2 / nwave
         self.t = 0
 
+    def depth(self):
+        return None
+
     def position(self):
         xy = np.empty(self._size + (2,), dtype=np.float32)
         xy[:, :, 0] = np.linspace(-1, 1, self._size[0])[:, None]
@@ -21,18 +128,50 @@ class PlaneWaves(object):
         self.t += dt
 
     def height_and_normal(self):
-        x = np.linspace(-1, 1, self._size[0])[:, None]
-        y = np.linspace(-1, 1, self._size[1])[None, :]
-        z = np.zeros(self._size, dtype=np.float32)
-        grad = np.zeros(self._size + (2,), dtype=np.float32)
+        return self.sample(self.t)
+
+    def sample(self, t, xy=None):
+        # xy is None for the whole grid, otherwise an array (..., 2) of probe points
+        # or a slice of position(); recent results are kept in a small LRU cache,
+        # bounded by cache_size entries and cache_bytes, and returned read-only
+        if xy is None:
+            key = (t, None)
+        else:
+            xy = np.asarray(xy, dtype=np.float32)
+            key = (t, xy.shape, xy.tobytes())
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if xy is None:
+            x = np.linspace(-1, 1, self._size[0])[:, None]
+            y = np.linspace(-1, 1, self._size[1])[None, :]
+        else:
+            x = xy[..., 0]
+            y = xy[..., 1]
+        result = self._evaluate(t, x, y)
+        for array in result:
+            array.setflags(write=False)
+        if sum(array.nbytes for array in result) <= self._cache_bytes:
+            self._cache[key] = result
+            while len(self._cache) > self._cache_size or self._cached_bytes() > self._cache_bytes:
+                self._cache.popitem(last=False)
+        return result
+
+    def _cached_bytes(self):
+        return sum(z.nbytes + grad.nbytes for z, grad in self._cache.values())
+
+    def _evaluate(self, t, x, y):
+        shape = np.broadcast(x, y).shape
+        z = np.zeros(shape, dtype=np.float32)
+        grad = np.zeros(shape + (2,), dtype=np.float32)
         for n in range(self._amplitude.shape[0]):
-            arg = self._phase[n] + x * self._wave_vector[n, 0] + y * self._wave_vector[n, 1] + self.t * \
+            arg = self._phase[n] + x * self._wave_vector[n, 0] + y * self._wave_vector[n, 1] + t * \
                                                                                                self._angular_frequency[
                                                                                                    n]
-            z[:, :] += self._amplitude[n] * np.cos(arg)
+            z[...] += self._amplitude[n] * np.cos(arg)
             dcos = -self._amplitude[n] * np.sin(arg)
-            grad[:, :, 0] += self._wave_vector[n, 0] * dcos
-            grad[:, :, 1] += self._wave_vector[n, 1] * dcos
+            grad[..., 0] += self._wave_vector[n, 0] * dcos
+            grad[..., 1] += self._wave_vector[n, 1] * dcos
         return z, grad
 
     def triangulation(self):
@@ -54,44 +193,71 @@ class PlaneWaves(object):
 
 
 class CircularWaves(PlaneWaves):
-    def __init__(self, size=(100, 100), max_height=0.1, wave_length=0.3, center=(0., 0.), speed=3):
+    def __init__(self, size=(100, 100), max_height=0.1, wave_length=0.3, center=(0., 0.), speed=3,
+                 cache_size=8, cache_bytes=64 * 2 ** 20):
         self._size = size
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_bytes = cache_bytes
         self._amplitude = max_height
         self._omega = 2 * np.pi / wave_length
         self._center = np.asarray(center, dtype=np.float32)
         self._speed = speed
         self.t = 0
 
-    def height_and_normal(self):
-        x = np.linspace(-1, 1, self._size[0])[:, None]
-        y = np.linspace(-1, 1, self._size[1])[None, :]
-        z = np.empty(self._size, dtype=np.float32)
-        grad = np.zeros(self._size + (2,), dtype=np.float32)
+    def _evaluate(self, t, x, y):
+        shape = np.broadcast(x, y).shape
+        z = np.empty(shape, dtype=np.float32)
+        grad = np.zeros(shape + (2,), dtype=np.float32)
         d = np.sqrt((x - self._center[0]) ** 2 + (y - self._center[1]) ** 2)
-        arg = self._omega * d - self.t * self._speed
-        z[:, :] = self._amplitude * np.cos(arg)
+        arg = self._omega * d - t * self._speed
+        z[...] = self._amplitude * np.cos(arg)
         dcos = -self._amplitude * self._omega * np.sin(arg)
-        grad[:, :, 0] += (x - self._center[0]) * dcos / d
-        grad[:, :, 1] += (y - self._center[1]) * dcos / d
+        # the slope is undefined exactly at the center, take it as flat there
+        dcos = np.where(d > 0, dcos / np.maximum(d, 1e-30), 0)
+        grad[..., 0] += (x - self._center[0]) * dcos
+        grad[..., 1] += (y - self._center[1]) * dcos
         return z, grad
 
 
 class ParallelWave(PlaneWaves):
-    def __init__(self, size=(100, 100), g=1, max_height=0.0000001, speed=1, tau=0.004):
+    def __init__(self, size=(100, 100), g=1, max_height=0.0000001, speed=1, tau=0.004, depth=None,
+                 initial="sine", initial_args=None):
+        # without depth the wave speed is `speed` everywhere; with a depth map it is
+        # c^2 = speed^2 * g * depth, so `speed` scales the shallow water speed
         self._size = size
         self._amplitude = max_height
         self._speed = speed
-        x = np.linspace(-1, 1, self._size[0] + 1)[:, None]
-        y = np.linspace(-1, 1, self._size[1])[None, :]
-        h = np.zeros(self._size, dtype=np.float32)
-        v = np.zeros(self._size, dtype=np.float32)
-        for i in range(size[0]):
-            value = max_height * np.sin(x[i] * np.pi)
-            h[i] = value
-            v[i] =  max_height * np.cos(x[i] * np.pi)
+        self._g = g
+        self._depth = None if depth is None else np.broadcast_to(np.asarray(depth, dtype=np.float32), size)
+        self._coefficients = self.face_coefficients()
+        if not callable(initial):
+            if initial not in INITIAL_CONDITIONS:
+                raise ValueError("unknown initial condition {!r}, expected one of {}".format(
+                    initial, sorted(INITIAL_CONDITIONS)))
+            initial = INITIAL_CONDITIONS[initial]
+        h, v = initial(size, max_height, **(initial_args or {}))
         self.p = np.array([h, v])
         self.tau = tau
         self.t = 0
+        self.steps = 0
+
+    def depth(self):
+        return self._depth
+
+    def field_time(self):
+        # p advances by tau on every height_and_normal call, independently of self.t
+        return self.steps * self.tau
+
+    def face_coefficients(self):
+        # c^2 = speed^2 * g * depth averaged onto the faces between neighbouring cells,
+        # computed once so the stencil costs the same as the constant-speed one
+        if self._depth is None:
+            return None
+        c2 = self._speed ** 2 * self._g * self._depth / (2 / self._size[0]) ** 2
+        cx = (c2 + np.roll(c2, -1, axis=0)) / 2
+        cy = (c2 + np.roll(c2, -1, axis=1)) / 2
+        return cx, cy
 
     def f(self, p):
         n = self._size[0]
@@ -105,6 +271,12 @@ class ParallelWave(PlaneWaves):
         # htop[0, :] = 0
         # hbot = np.roll(h, -1, axis=0)
         # hbot[-1, :] = 0
+        if self._coefficients is not None:
+            cx, cy = self._coefficients
+            fx = cx * (np.roll(h, -1, axis=0) - h)
+            fy = cy * (np.roll(h, -1, axis=1) - h)
+            vt = fx - np.roll(fx, 1, axis=0) + fy - np.roll(fy, 1, axis=1)
+            return np.array([ht, vt])
         hleft = np.roll(h, 1, axis=1)
         hright = np.roll(h, -1, axis=1)
         htop = np.roll(h, 1, axis=0)
@@ -117,13 +289,30 @@ class ParallelWave(PlaneWaves):
         y = np.linspace(-1, 1, self._size[1])[None, :]
         if self.t != self.tau:
             self.update_p()
+            self.steps += 1
 
+        np_sum = np.sum(self.p[0])
+        print(self.t, "{:e}".format(np_sum))
+        return self.p[0], self.normal()
+
+    def normal(self):
         grad = np.zeros(self._size + (2,), dtype=np.float32)
         grad[:, :, 0] = self.p[1]
         grad[:, :, 1] = 0
-        np_sum = np.sum(self.p[0])
-        print(self.t, "{:e}".format(np_sum))
-        return self.p[0], grad
+        return grad
+
+    def sample(self, t, xy=None):
+        # only the field after the last step exists, at field_time(); probe points are
+        # interpolated bilinearly and get the same normal that height_and_normal draws
+        if t != self.field_time():
+            raise ValueError("ParallelWave holds its field at field_time() {} (step {}), not at {}".format(
+                self.field_time(), self.steps, t))
+        h = self.p[0]
+        grad = self.normal()
+        if xy is None:
+            return h.copy(), grad
+        xy = np.asarray(xy, dtype=np.float32)
+        return _bilinear(h, xy[..., 0], xy[..., 1]), _bilinear(grad, xy[..., 0], xy[..., 1])
 
     def update_p(self):
         k1 = self.f(self.p)
@@ -134,8 +323,8 @@ class ParallelWave(PlaneWaves):
 
 
 class ParallelWaveEuler(ParallelWave):
-    def __init__(self):
-        ParallelWave.__init__(self)
+    def __init__(self, **kwargs):
+        ParallelWave.__init__(self, **kwargs)
 
     def update_p(self):
         temP = self.p + self.tau * self.f(self.p)